@@ -1,10 +1,24 @@
 from __future__ import absolute_import
 
+import collections
+import hashlib
+import json
+import threading
 import typing
 
 import werkzeug.contrib.cache
 
 ACL_OPTIONS_CACHE_TTL = 3600 * 1
+ACL_OPTIONS_CACHE_KEY = 'acl_options_parsed'
+USER_ACL_CACHE_SIZE = 4096
+
+# Global mask, local mask and negated privileges of a privileges query
+_QueryMasks = typing.Tuple[int, int, tuple]
+
+# ACLs are keyed by forum id strings, spare str() for common forum ids
+_FORUM_ID_STRINGS = dict(
+    (forum_id, str(forum_id)) for forum_id in range(1024)
+)  # type: typing.Dict[int, str]
 
 
 class BaseBackend(object):
@@ -58,6 +72,15 @@ class BaseBackend(object):
         # type: (...) -> typing.Any
         raise NotImplementedError
 
+    def invalidate(
+        self,
+        command,  # type: str
+        **kwargs  # type: typing.Any
+    ):
+        # type: (...) -> None
+        """Drops cached result of a command executed with kwargs."""
+        raise NotImplementedError
+
     def close(self):
         # type: () -> None
         raise NotImplementedError
@@ -69,22 +92,121 @@ class BaseBackend(object):
 
     def get_user_acl(self, raw_user_permissions):
         # type: (str) -> UserAcl
+        acl_options_revision, acl_options = self._get_acl_options()
+        return UserAcl.get_cached(
+            acl_options_revision,
+            acl_options,
+            raw_user_permissions,
+        )
+
+    def _get_acl_options(self):
+        # type: () -> typing.Tuple[str, dict]
+        """Returns parsed ACL options and their revision, parsing them only
+        once per cache lifetime."""
+        raw_data = self._cache.get(ACL_OPTIONS_CACHE_KEY)
+        if raw_data:
+            try:
+                acl_options_revision, acl_options = json.loads(raw_data)
+                return acl_options_revision, acl_options
+            except ValueError:
+                # Woops :S
+                pass
+
         raw_acl_options = self.execute(
             'fetch_acl_options',
-            cache=True,
-            cache_ttl=ACL_OPTIONS_CACHE_TTL,
             limit=None,
         )
+        acl_options_revision = UserAcl._get_options_revision(
+            raw_acl_options
+        )
+        acl_options = UserAcl._parse_acl_options(raw_acl_options)
 
-        return UserAcl(raw_acl_options, raw_user_permissions)
+        self._cache.set(
+            ACL_OPTIONS_CACHE_KEY,
+            json.dumps([acl_options_revision, acl_options]),
+            timeout=ACL_OPTIONS_CACHE_TTL,
+        )
+
+        return acl_options_revision, acl_options
 
 
 class UserAcl(object):
+    # Parsed ACLs shared across requests, in least recently used order
+    _instances = collections.OrderedDict()\
+        # type: collections.OrderedDict[typing.Tuple[str, str], UserAcl]
+    _instances_lock = threading.Lock()
+
     def __init__(self, raw_acl_options, raw_user_permissions):
         # type: (typing.List[dict], str) -> None
-        self._acl_options = self._parse_acl_options(raw_acl_options)
+        self._load(
+            self._parse_acl_options(raw_acl_options),
+            raw_user_permissions,
+        )
+
+    @classmethod
+    def from_parsed(cls, acl_options, raw_user_permissions):
+        # type: (dict, str) -> UserAcl
+        """Creates ACL from already parsed ACL options."""
+        user_acl = cls.__new__(cls)  # type: UserAcl
+        user_acl._load(acl_options, raw_user_permissions)
+        return user_acl
+
+    def _load(self, acl_options, raw_user_permissions):
+        # type: (dict, str) -> None
+        self._acl_options = acl_options
         self._acl = self._parse_user_permissions(raw_user_permissions)
-        self._acl_lookup_cache = {}  # type: dict
+        self._query_mask_cache = {}\
+            # type: typing.Dict[typing.Tuple[str, ...], _QueryMasks]
+        self._option_index = None\
+            # type: typing.Optional[typing.Dict[str, typing.Tuple[int, int]]]
+
+    @classmethod
+    def get_cached(
+        cls,
+        acl_options_revision,  # type: str
+        acl_options,  # type: dict
+        raw_user_permissions,  # type: str
+    ):
+        # type: (...) -> UserAcl
+        """Returns parsed ACL, reusing instances built for the same
+        permissions and ACL options."""
+        key = (acl_options_revision, raw_user_permissions)
+
+        with cls._instances_lock:
+            user_acl = cls._instances.pop(key, None)
+            if user_acl is not None:
+                cls._instances[key] = user_acl
+                return user_acl
+
+        user_acl = cls.from_parsed(acl_options, raw_user_permissions)
+
+        with cls._instances_lock:
+            cls._instances[key] = user_acl
+            while len(cls._instances) > USER_ACL_CACHE_SIZE:
+                cls._instances.popitem(last=False)
+
+        return user_acl
+
+    @classmethod
+    def invalidate(cls, raw_user_permissions):
+        # type: (str) -> None
+        """Drops cached ACLs built from given permissions."""
+        with cls._instances_lock:
+            for key in list(cls._instances):
+                if key[1] == raw_user_permissions:
+                    del cls._instances[key]
+
+    @classmethod
+    def _get_options_revision(cls, raw_acl_options):
+        # type: (typing.List[dict]) -> str
+        # Stored in the shared cache, so it must not differ across processes
+        rows = [
+            [opt['auth_option'], opt['is_local'], opt['is_global']]
+            for opt in raw_acl_options or []
+        ]
+        return hashlib.sha1(
+            json.dumps(rows, sort_keys=True).encode('utf-8')
+        ).hexdigest()
 
     @classmethod
     def _parse_acl_options(cls, raw_acl_options):
@@ -113,8 +235,9 @@ class UserAcl(object):
 
     @classmethod
     def _parse_user_permissions(cls, raw_user_permissions):
-        # type: (str) -> dict
+        # type: (str) -> typing.Dict[str, int]
         seq_cache = {}  # type: dict
+        line_cache = {}  # type: dict
         acl = {}
 
         split_user_permissions = raw_user_permissions\
@@ -124,67 +247,121 @@ class UserAcl(object):
             if not perms:
                 continue
 
-            # Do the conversion magic
-            acl[str(forum_id)] = ''
-            for sub in [perms[j:j + 6] for j in range(0, len(perms), 6)]:
+            # Forums commonly share the very same permission set, so
+            # identical lines are decoded only once
+            if perms in line_cache:
+                acl[str(forum_id)] = line_cache[perms]
+                continue
+
+            # Do the conversion magic, two 6 character chunks at a time to
+            # halve lookups (a line may end with a single chunk)
+            converted_perms = []
+            for sub in [perms[j:j + 12] for j in range(0, len(perms), 12)]:
                 if sub in seq_cache:
                     converted = seq_cache[sub]
                 else:
-                    converted = bin(int(sub, 36))[2:]
-                    converted = seq_cache[sub] = '0'\
-                                                 * (31 - len(converted))\
-                                                 + converted
+                    converted = seq_cache[sub] = ''.join(
+                        bin(int(sub[k:k + 6], 36))[2:].zfill(31)
+                        for k in range(0, len(sub), 6)
+                    )
+
+                converted_perms.append(converted)
 
-                acl[str(forum_id)] += converted
+            # Keep the permissions as a bitset, where bit N holds the value
+            # of the N-th ACL option
+            acl[str(forum_id)] = line_cache[perms] =\
+                int(''.join(converted_perms)[::-1], 2)
 
         return acl
 
     def has_privilege(self, privilege, forum_id=0):
         # type: (str, int) -> bool
         # Parse negation
-        str_forum_id = str(forum_id)
-
         negated = privilege.startswith('!')
         if negated:
             option = privilege[1:]
         else:
             option = privilege
 
-        self._acl_lookup_cache.setdefault(str_forum_id, {})[option] = False
+        option_index = self._option_index
+        if option_index is None:
+            option_index = self._build_option_index()
+        global_option, local_option = option_index.get(option, (-1, -1))
+
+        permission = 0
 
         # Global permissions
-        if option in self._acl_options['global']\
-           and '0' in self._acl:
-            try:
-                acl_option = self._acl_options['global'][option]
-                permission = self._acl['0'][acl_option]
-                self._acl_lookup_cache[str_forum_id][option] =\
-                    bool(int(permission))
-            except IndexError:
-                pass
+        if global_option >= 0:
+            permission |= (self._acl.get('0', 0) >> global_option) & 1
 
         # Local permissions
-        if str_forum_id != '0'\
-           and option in self._acl_options['local']:
-            try:
-                acl_option = self._acl_options['local'][option]
-                permission =\
-                    self._acl.get(str_forum_id, '0' * 31)[acl_option]
-                self._acl_lookup_cache[str_forum_id][option] |=\
-                    bool(int(permission))
-            except IndexError:
-                pass
+        if local_option >= 0:
+            str_forum_id = _FORUM_ID_STRINGS.get(forum_id) or str(forum_id)
+            if str_forum_id != '0':
+                permission |=\
+                    (self._acl.get(str_forum_id, 0) >> local_option) & 1
+
+        return bool(permission ^ negated)
+
+    def _build_option_index(self):
+        # type: () -> typing.Dict[str, typing.Tuple[int, int]]
+        """Maps options to their global and local index, -1 if missing."""
+        global_options = self._acl_options['global']
+        local_options = self._acl_options['local']
+
+        self._option_index = dict(
+            (option, (
+                global_options.get(option, -1),
+                local_options.get(option, -1),
+            ))
+            for option in set(global_options) | set(local_options)
+        )
+        return self._option_index
+
+    def _get_query_masks(self, privileges):
+        # type: (typing.Tuple[str, ...]) -> typing.Tuple[int, int, tuple]
+        """Returns global and local bitmasks of privileges and the negated
+        ones, which can not be folded into a mask."""
+        if privileges in self._query_mask_cache:
+            return self._query_mask_cache[privileges]
+
+        global_mask = 0
+        local_mask = 0
+        negated = []
+        for privilege in privileges:
+            if privilege.startswith('!'):
+                negated.append(privilege)
+                continue
 
-        output = (
-            negated ^ self._acl_lookup_cache[str_forum_id][option]
-        )  # type: bool
+            acl_option = self._acl_options['global'].get(privilege)
+            if acl_option is not None:
+                global_mask |= 1 << acl_option
+            acl_option = self._acl_options['local'].get(privilege)
+            if acl_option is not None:
+                local_mask |= 1 << acl_option
+
+        output = self._query_mask_cache[privileges] = (
+            global_mask,
+            local_mask,
+            tuple(negated),
+        )
         return output
 
     def has_privileges(self, *privileges, **kwargs):
         # type: (*str, **int) -> bool
         forum_id = kwargs.get('forum_id', 0)
+        global_mask, local_mask, negated = self._get_query_masks(privileges)
 
-        output = False
-        for option in privileges:
-            output |= self.has_privilege(option, forum_id=forum_id)
-        return output
+        # Global permissions
+        if self._acl.get('0', 0) & global_mask:
+            return True
+
+        # Local permissions
+        str_forum_id = _FORUM_ID_STRINGS.get(forum_id) or str(forum_id)
+        if str_forum_id != '0' and self._acl.get(str_forum_id, 0) & local_mask:
+            return True
+
+        for privilege in negated:
+            if self.has_privilege(privilege, forum_id=forum_id):
+                return True
+        return False
@@ -143,11 +143,7 @@ class Psycopg2Backend(base.BaseBackend):
 
         cache_key = None
         if cache_key_prefix and operation != 'set':
-            cache_key = '{name}:{arguments}'.format(
-                name=cache_key_prefix,
-                arguments=':'.join(key + str(value)
-                                   for key, value in kwargs.items())
-            )
+            cache_key = self._get_cache_key(cache_key_prefix, kwargs)
             raw_data = self._cache.get(cache_key)
             if raw_data and isinstance(raw_data, (str, unicode)):
                 try:
@@ -172,6 +168,14 @@ class Psycopg2Backend(base.BaseBackend):
 
         return output
 
+    def _get_cache_key(self, name, params):
+        # type: (str, typing.Dict[str, typing.Union[str, int]]) -> str
+        return '{name}:{arguments}'.format(
+            name=name,
+            arguments=':'.join(key + str(value)
+                               for key, value in sorted(params.items()))
+        )
+
     def _paginate_query(self, query, skip, limit):
         # type: (str, int, typing.Optional[int]) -> str
         output = query + ' OFFSET {:d}'.format(skip)
@@ -246,11 +250,17 @@ class Psycopg2Backend(base.BaseBackend):
                 **kwargs
             )
 
+    def invalidate(self, command, **kwargs):
+        # type: (str, **typing.Union[int, str]) -> None
+        self._cache.delete(self._get_cache_key(command, kwargs))
+
     def close(self):
         # type: () -> None
-        self._db.close()
+        # Going through _db would connect only to close the connection
+        if self._connection is not None:
+            self._connection.close()
 
     @property
     def is_closed(self):
         # type: () -> bool
-        return bool(self._db.closed)
+        return self._connection is not None and bool(self._connection.closed)
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import re
 import typing
 
 import flask
@@ -50,6 +51,12 @@ class PhpBB3(object):
         # Add ourselves to the app, so session interface can function
         app.phpbb3 = self
         app.phpbb3_cache = cache_driver
+        app.phpbb3_backend_class = self._get_backend_class(
+            app.config['PHPBB3']['DRIVER']
+        )
+        app.phpbb3_botlist = self._compile_botlist(
+            app.config['PHPBB3_BOTLIST']
+        )
 
         # Use our session interface
         # TODO Is it wise to do it here? Should user do it himself?
@@ -72,6 +79,7 @@ class PhpBB3(object):
         app.config['PHPBB3_DATABASE'].setdefault('CUSTOM_STATEMENTS', {})
         app.config.setdefault('PHPBB3_SESSION_BACKEND', {})
         app.config['PHPBB3_SESSION_BACKEND'].setdefault('TYPE', 'simple')
+        app.config['PHPBB3_SESSION_BACKEND'].setdefault('LOCAL_CACHE_TTL', 0)
         app.config.setdefault('PHPBB3_BOTLIST', [])
 
         # Conditional defaults
@@ -86,19 +94,22 @@ class PhpBB3(object):
             )
 
     @classmethod
-    def _create_backend(
-        cls,
-        backend_type,  # type: str
-        config,  # type: dict
-        cache  # type: werkzeug.contrib.cache.BaseCache
-    ):
-        # type: (...) -> flask_phpbb3.backends.base.BaseBackend
+    def _compile_botlist(cls, botlist):
+        # type: (typing.List[str]) -> typing.Optional[typing.Pattern]
+        """Compiles user agent prefixes into a single pattern."""
+        if not botlist:
+            return None
+
+        return re.compile('(?:{})'.format(
+            '|'.join(re.escape(user_agent) for user_agent in botlist)
+        ))
+
+    @classmethod
+    def _get_backend_class(cls, backend_type):
+        # type: (str) -> typing.Type[flask_phpbb3.backends.base.BaseBackend]
         if backend_type == 'psycopg2':
             import flask_phpbb3.backends.psycopg2
-            return flask_phpbb3.backends.psycopg2.Psycopg2Backend(
-                cache,
-                config,
-            )
+            return flask_phpbb3.backends.psycopg2.Psycopg2Backend
         else:
             raise ValueError('Unsupported driver {}'.format(backend_type))
 
@@ -106,22 +117,22 @@ class PhpBB3(object):
     def _backend(self):
         # type: () -> flask_phpbb3.backends.base.BaseBackend
         """Returns phpbb3 backend"""
-        current_app = self.app or flask.current_app
-
         ctx = flask._app_ctx_stack.top
-        if ctx is not None:
-            if not hasattr(ctx, 'phpbb3_backend')\
-               or ctx.phpbb3_backend.is_closed:
-                backend = PhpBB3._create_backend(
-                    current_app.config['PHPBB3']['DRIVER'],
-                    current_app.config['PHPBB3_DATABASE'],
-                    current_app.phpbb3_cache,
-                )
-                ctx.phpbb3_backend = backend
-            else:
-                backend = ctx.phpbb3_backend
-            return backend
-        raise AttributeError('No context available')
+        if ctx is None:
+            raise AttributeError('No context available')
+
+        # Every API call goes through here, keep the common path short
+        backend = getattr(ctx, 'phpbb3_backend', None)\
+            # type: typing.Optional[flask_phpbb3.backends.base.BaseBackend]
+        if backend is None or backend.is_closed:
+            current_app = self.app or flask.current_app
+            new_backend = current_app.phpbb3_backend_class(
+                current_app.phpbb3_cache,
+                current_app.config['PHPBB3_DATABASE'],
+            )  # type: flask_phpbb3.backends.base.BaseBackend
+            ctx.phpbb3_backend = new_backend
+            return new_backend
+        return backend
 
     def get_autologin(self, key, cache=False, cache_ttl=None):
         # type: (str, bool, typing.Optional[int]) -> typing.Optional[dict]
@@ -229,6 +240,13 @@ class PhpBB3(object):
         )  # type: typing.Optional[dict]
         return output
 
+    def invalidate_unread_notifications_count(self, user_id):
+        # type: (int) -> None
+        self._backend.invalidate(
+            'get_unread_notifications_count',
+            user_id=user_id,
+        )
+
     def get_user_acl(self, raw_user_permissions):
         # type: (str) -> flask_phpbb3.backends.base.UserAcl
         return self._backend.get_user_acl(raw_user_permissions)
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import hashlib
 import json
 import typing
 
@@ -12,16 +13,52 @@ import flask_phpbb3.backends.base
 
 import werkzeug.contrib.cache
 
+
+try:
+    import orjson
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps  # type: typing.Callable[[typing.Any], str]
+else:
+    def _orjson_dumps(data):
+        # type: (typing.Any) -> str
+        # Like json.dumps, turn non string keys into strings instead of failing
+        output = orjson.dumps(
+            data,
+            option=orjson.OPT_NON_STR_KEYS,
+        ).decode('utf-8')  # type: str
+        return output
+
+    if hasattr(orjson, 'OPT_NON_STR_KEYS'):
+        _json_loads = orjson.loads
+        _json_dumps = _orjson_dumps
+    else:
+        # orjson releases before 3.0 can not serialize non string keys
+        _json_loads = json.loads
+        _json_dumps = json.dumps
+
 ANONYMOUS_CACHE_TTL = 3600 * 24
+LOCAL_CACHE_THRESHOLD = 2048
+UNREAD_NOTIFICATIONS_CACHE_TTL = 5
 
 
 class PhpBB3Session(dict, flask.sessions.SessionMixin):
+    __slots__ = (
+        'modified',
+        'new',
+        '_read_only_properties',
+        '_acl',
+        '_request_cache',
+        '_stored_data',
+    )
+
     def __init__(self):
         # type: () -> None
         # Some session related variables
         self.modified = False
         self.new = False
-        self._read_only_properties = set([])  # type: set
+        self._read_only_properties = set([])\
+            # type: typing.AbstractSet[str]
 
         # Some ACL related things
         self._acl = None\
@@ -32,12 +69,14 @@ class PhpBB3Session(dict, flask.sessions.SessionMixin):
         # request should not be executed multiple times
         self._request_cache = {}  # type: dict
 
+        # Serialized data as read from session backend
+        self._stored_data = None  # type: typing.Optional[str]
+
     def __setitem__(self, key, value):
         # type: (str, typing.Union[str, int]) -> None
         modified = self.get(key) != value
-        super(PhpBB3Session, self).__setitem__(key, value)
-        if key not in self._read_only_properties:
-            self.modified |= modified
+        dict.__setitem__(self, key, value)
+        self.modified |= modified and key not in self._read_only_properties
 
     def __delitem__(self, key):
         # type: (str) -> None
@@ -50,11 +89,12 @@ class PhpBB3Session(dict, flask.sessions.SessionMixin):
         output = flask.current_app.phpbb3  # type: flask_phpbb3.PhpBB3
         return output
 
-    def pop(self, *args, **kwargs):
-        # type: (*typing.Any, **typing.Any) -> typing.Any
+    def pop(self, key, *args):
+        # type: (str, *typing.Any) -> typing.Any
         """Wrapper to set modified."""
-        self.modified = True
-        return super(PhpBB3Session, self).pop(*args, **kwargs)
+        if key in self:
+            self.modified = True
+        return super(PhpBB3Session, self).pop(key, *args)
 
     def clear(self):
         # type: () -> None
@@ -110,12 +150,14 @@ class PhpBB3Session(dict, flask.sessions.SessionMixin):
 
     def get_link_hash(self, link):
         # type: (str) -> str
-        """Returns link hash."""
+        """Returns link hash, as checked by phpBB3's check_link_hash."""
         if not self.is_authenticated:
             return ''
 
-        import hashlib
-        return hashlib.sha1(self['user_form_salt'] + link).hexdigest()[:8]
+        salted_link = self['user_form_salt'] + link
+        if not isinstance(salted_link, bytes):
+            salted_link = salted_link.encode('utf-8')
+        return hashlib.sha1(salted_link).hexdigest()[:8]
 
     @property
     def num_unread_notifications(self):
@@ -123,7 +165,9 @@ class PhpBB3Session(dict, flask.sessions.SessionMixin):
         """Returns number of unread notifications."""
         if 'num_unread_notifications' not in self._request_cache:
             result = self._phpbb3.get_unread_notifications_count(
-                user_id=self['user_id']
+                user_id=self['user_id'],
+                cache=True,
+                cache_ttl=UNREAD_NOTIFICATIONS_CACHE_TTL,
             )
             if result:
                 unread_count = int(result['num'])
@@ -141,17 +185,50 @@ class PhpBB3SessionInterface(flask.sessions.SessionInterface):
     """A read-only session interface to access phpBB3 session."""
     session_class = PhpBB3Session
 
+    def __init__(self):
+        # type: () -> None
+        # Per process cache in front of the session backend
+        self._local_cache = werkzeug.contrib.cache.SimpleCache(
+            threshold=LOCAL_CACHE_THRESHOLD,
+        )
+
     @classmethod
     def _cache(cls, app):
         # type: (flask.Flask) -> werkzeug.contrib.cache.BaseCache
         output = app.phpbb3_cache  # type: werkzeug.contrib.cache.BaseCache
         return output
 
+    def _get_stored_data(self, app, key):
+        # type: (flask.Flask, str) -> typing.Optional[str]
+        """Reads raw session data, trying local cache first."""
+        local_ttl = app.config['PHPBB3_SESSION_BACKEND']['LOCAL_CACHE_TTL']
+        if local_ttl:
+            local_data = self._local_cache.get(key)\
+                # type: typing.Optional[str]
+            if local_data is not None:
+                return local_data
+
+        data = self._cache(app).get(key)  # type: typing.Optional[str]
+        if local_ttl and data is not None:
+            self._local_cache.set(key, data, timeout=local_ttl)
+        return data
+
+    def _set_stored_data(self, app, key, data):
+        # type: (flask.Flask, str, str) -> None
+        """Writes raw session data to session backend and local cache."""
+        # TODO Read session validity from phpbb3 config
+        self._cache(app).set(key, data, timeout=int(3600 * 1.5))
+
+        local_ttl = app.config['PHPBB3_SESSION_BACKEND']['LOCAL_CACHE_TTL']
+        if local_ttl:
+            self._local_cache.set(key, data, timeout=local_ttl)
+
     def _is_bot(self, app, request):
-        for user_agent in app.config['PHPBB3_BOTLIST']:
-            if request.headers.get('User-Agent', '').startswith(user_agent):
-                return True
-        return False
+        # type: (flask.Flask, flask.wrappers.Request) -> bool
+        botlist = app.phpbb3_botlist  # type: typing.Optional[typing.Pattern]
+        if botlist is None:
+            return False
+        return botlist.match(request.headers.get('User-Agent', '')) is not None
 
     def open_session(self, app, request):
         # type: (flask.Flask, flask.wrappers.Request) -> PhpBB3Session
@@ -167,13 +244,14 @@ class PhpBB3SessionInterface(flask.sessions.SessionInterface):
             session_id = None
 
         user = None
-        if self._is_bot(app, request):
-            user = {'user_id': 1, 'username': 'Anonymous'}
-        elif session_id:
+        if session_id:
             # Try to fetch session
             user = phpbb3.get_session(session_id=session_id)
-            if user and 'username' in user:
+            if user and isinstance(user.get('username'), bytes):
                 user['username'] = user['username'].decode('utf-8', 'ignore')
+        if not user and self._is_bot(app, request):
+            # Bots never get a session, skip fetching the anonymous user
+            user = {'user_id': 1, 'username': 'Anonymous'}
         if not user:
             # Use anonymous user
             user = phpbb3.get_user(
@@ -187,38 +265,45 @@ class PhpBB3SessionInterface(flask.sessions.SessionInterface):
 
         # Set session data
         if isinstance(user, dict) and user:
-            session._read_only_properties = set(user.keys())
+            # Plain dict.update, initial data must not mark session modified
+            session._read_only_properties = frozenset(user.keys())
             session.update(user)
 
             # Read from local storage backend
-            if 'session_id' in session:
-                cache = self._cache(app)
-                data = cache.get('sessions_' + session['session_id'])
+            if 'session_id' in user:
+                session._stored_data = self._get_stored_data(
+                    app,
+                    'sessions_' + user['session_id'],
+                )
                 try:
-                    data = json.loads(data or '')
+                    data = _json_loads(session._stored_data or '')
                 except ValueError:
                     data = None
-                if not isinstance(data, dict):
-                    data = {}
-            else:
-                data = {}
-            session.update(data)
+                if isinstance(data, dict) and data:
+                    session.update(data)
 
         return session
 
     def save_session(self, app, session, response):
         # type: (flask.Flask, PhpBB3Session, flask.wrappers.Response) -> None
-        """Currenlty does nothing."""
-        if session.modified and session._read_only_properties:
-            # Store all 'storable' properties
-            data = dict([(k, v)
-                         for k, v in session.items()
-                         if k not in session._read_only_properties])
-
-            if 'session_id' in session:
-                # TODO Read session validity from phpbb3 config
-                self._cache(app).set(
-                    'sessions_' + session['session_id'],
-                    json.dumps(data),
-                    timeout=int(3600 * 1.5)
-                )
+        """Stores non phpBB3 properties into session backend."""
+        if not session.modified\
+           or not session._read_only_properties\
+           or 'session_id' not in session:
+            return
+
+        # Store all 'storable' properties
+        data = dict([(k, v)
+                     for k, v in session.items()
+                     if k not in session._read_only_properties])
+
+        stored_data = _json_dumps(data)
+        if stored_data == session._stored_data:
+            # Modified, but ended up the same as it was
+            return
+
+        self._set_stored_data(
+            app,
+            'sessions_' + session['session_id'],
+            stored_data,
+        )
@@ -1,41 +1,156 @@
 from __future__ import absolute_import
 
+import atexit
+import hashlib
+import io
+import json
+import os
 import typing
 import unittest
 
 import flask
 
 import flask_phpbb3
+import flask_phpbb3.sessions
+
+import jinja2
 
 import psycopg2
 import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 
 
 DB_HOST = '127.0.0.1'
 DB_ROOT_USER = 'postgres'
 DB_USER = 'phpbb3_test'
-DB_NAME = 'phpbb3_test'
+# Every pytest-xdist worker gets a database of its own
+DB_NAME = 'phpbb3_test_{worker}'.format(
+    worker=os.environ.get('PYTEST_XDIST_WORKER', 'gw0'),
+)
+DB_TEMPLATE_NAME = 'phpbb3_test_template'
+SCHEMA_PATH = './tests/fixtures/postgres/schema.sql'
+
+# Connection shared by all tests of a module, isolated with savepoints
+_connection = None  # type: typing.Optional[psycopg2.extensions.connection]
+
+# Fixture queries, prepared once on the shared connection
+FIXTURE_STATEMENTS = {
+    'create_user': (
+        "insert into"
+        " phpbb_users (user_id, username, username_clean)"
+        " values (2, 'test', 'test')"
+    ),
+    'create_session': (
+        "insert into"
+        " phpbb_sessions (session_id, session_user_id)"
+        " values ($1, $2)"
+    ),
+    'create_privilege': (
+        "insert into"
+        " phpbb_acl_options (auth_option_id, auth_option, is_global)"
+        " values ($1, $2, 1)"
+    ),
+    'grant_privilege': (
+        "update phpbb_users"
+        " set"
+        " user_permissions=$1"
+        " where user_id=$2"
+    ),
+}
+
+# Contents of SCHEMA_PATH, read once per process
+_schema_sql = None  # type: typing.Optional[typing.Text]
+
+# Anonymous user row, same for every test as it comes from the schema
+_anonymous_user = None  # type: typing.Optional[dict]
+
+# Superuser connections, reused by every module to create and drop databases
+_admin_pool = None\
+    # type: typing.Optional[psycopg2.pool.ThreadedConnectionPool]
 
 
 def setUpModule():
     # type: () -> None
-    _create_db()
-    connection = _get_connection(DB_HOST, DB_USER, DB_NAME)
-    _init_schema(connection)
-    connection.commit()
+    global _connection
+
+    # Check template and clone it in a single admin session
+    admin_connection = _get_admin_connection()
+    cursor = admin_connection.cursor()  # type: psycopg2.extensions.cursor
+    try:
+        _ensure_template_db(cursor)
+        _create_db(cursor)
+    finally:
+        cursor.close()
+        _put_admin_connection(admin_connection)
+
+    _connection = _get_connection(
+        DB_HOST,
+        DB_USER,
+        DB_NAME,
+        connection_factory=psycopg2.extras.DictConnection,
+    )
+    _prepare_fixture_statements(_connection)
 
 
 def tearDownModule():
     # type: () -> None
+    global _connection
+
+    if _connection is not None:
+        _connection.rollback()
+        _connection.close()
+        _connection = None
     _destory_db()
 
 
+test_blueprint = flask.Blueprint('test', __name__)
+
+# Templates are loaded by name, so Jinja compiles each once per app
+test_blueprint.jinja_loader = jinja2.DictLoader({
+    'index.html': '{{ session.user_id}},{{ session.username }}',
+    'data.html': '{{ session.custom_var}}',
+    'set_data.html': 'Done :o',
+    'privileges.html': (
+        "{{ session.has_privilege('m_edit') }},"
+        "{{ session.has_privilege('m_delete') }},"
+        "{{ session.is_authenticated }}"
+    ),
+})
+
+
+# From these lines devil is born
+@test_blueprint.route('/')
+def index():
+    # type: () -> typing.Any
+    return flask.render_template('index.html')
+
+
+@test_blueprint.route('/data')
+def data():
+    # type: () -> typing.Any
+    return flask.render_template('data.html')
+
+
+@test_blueprint.route('/data/<package>')
+def set_data(package):
+    # type: (str) -> typing.Any
+    flask.session['custom_var'] = package
+    return flask.render_template('set_data.html')
+
+
+@test_blueprint.route('/priv_test')
+def test_privileges():
+    # type: () -> typing.Any
+    return flask.render_template('privileges.html')
+
+
 class TestWithDatabase(unittest.TestCase):
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         # type: () -> None
-        self.app = flask.Flask('test_app')
-        self.app.config.update({
+        cls.app = flask.Flask('test_app')
+        cls.app.config.update({
             'PHPBB3': {
                 'DRIVER': 'psycopg2',
                 'VERSION': '3.2',
@@ -48,74 +163,106 @@ class TestWithDatabase(unittest.TestCase):
                 'TABLE_PREFIX': 'phpbb_',
             },
         })
-        self.phpbb3 = flask_phpbb3.PhpBB3(self.app)
-
-        # From these lines devil is born
-        @self.app.route('/')
-        def index():
-            # type: () -> typing.Any
-            return flask.render_template_string(
-                '{{ session.user_id}},{{ session.username }}'
-            )
-
-        @self.app.route('/data')
-        def data():
-            # type: () -> typing.Any
-            return flask.render_template_string(
-                '{{ session.custom_var}}'
-            )
-
-        @self.app.route('/data/<package>')
-        def set_data(package):
-            # type: (str) -> typing.Any
-            flask.session['custom_var'] = package
-            return flask.render_template_string(
-                'Done :o'
-            )
-
-        @self.app.route('/priv_test')
-        def test_privileges():
-            # type: () -> typing.Any
-            return flask.render_template_string(
-                "{{ session.has_privilege('m_edit') }},"
-                "{{ session.has_privilege('m_delete') }},"
-                "{{ session.is_authenticated }}"
-            )
-
-        self.ctx = self.app.app_context()
-        self.ctx.push()
-
-        # Init connection
-        self.connection = self.phpbb3._backend._db
+        cls.phpbb3 = flask_phpbb3.PhpBB3(cls.app)
+        cls.app.register_blueprint(test_blueprint)
+
+        cls.ctx = cls.app.app_context()
+        cls.ctx.push()
+
+        # Setup client, cookies are passed as headers so no state is kept
+        cls.client = cls.app.test_client(use_cookies=False)
+
+        # Reuse module connection, changes are undone on savepoint rollback
+        cls.connection = _connection
+        cls.phpbb3._backend._connection = cls.connection
+        cls._prime_anonymous_user()
+
+        cursor = cls.connection.cursor()  # type: psycopg2.extensions.cursor
+        cursor.execute('savepoint class_sp')
+        cls._create_class_fixtures(cursor)
+        cursor.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        # type: () -> None
+        cursor = cls.connection.cursor()  # type: psycopg2.extensions.cursor
+        cursor.execute('rollback to savepoint class_sp')
+        cursor.execute('release savepoint class_sp')
+        cursor.close()
+
+        # Keep shared connection open on context teardown
+        cls.phpbb3._backend._connection = None
+        cls.ctx.pop()
+
+    @classmethod
+    def _prime_anonymous_user(cls):
+        # type: () -> None
+        """Caches anonymous user, as looked up by every anonymous request."""
+        global _anonymous_user
+
+        if _anonymous_user is None:
+            _anonymous_user = cls.phpbb3.get_user(user_id=1)
+
+        cls.app.phpbb3_cache.set(
+            cls._get_anonymous_user_cache_key(),
+            json.dumps(_anonymous_user),
+            flask_phpbb3.sessions.ANONYMOUS_CACHE_TTL,
+        )
+
+    @classmethod
+    def _get_anonymous_user_cache_key(cls):
+        # type: () -> str
+        return cls.phpbb3._backend._get_cache_key('get_user', {'user_id': 1})
+
+    def _unprime_anonymous_user(self):
+        # type: () -> None
+        """Makes next anonymous request look anonymous user up in database."""
+        self.app.phpbb3_cache.delete(self._get_anonymous_user_cache_key())
+
+    @classmethod
+    def _create_class_fixtures(cls, cursor):
+        # type: (psycopg2.extensions.cursor) -> None
+        """Creates rows shared by all tests of the class."""
+        pass
+
+    def setUp(self):
+        # type: () -> None
         self.cursor = self.connection.cursor()\
             # type: psycopg2.extensions.cursor
-
-        # Setup client
-        self.client = self.app.test_client()
+        self.cursor.execute('savepoint test_sp')
 
     def tearDown(self):
         # type: () -> None
-        self.connection.rollback()
+        self.cursor.execute('rollback to savepoint test_sp')
+        self.cursor.execute('release savepoint test_sp')
         self.cursor.close()
 
-        self.ctx.pop()
+        # Do not leak cached rows and sessions into following tests
+        self.app.phpbb3_cache.clear()
+        self.app.session_interface._local_cache.clear()
+        self._prime_anonymous_user()
+
+
+def _prepare_fixture_statements(connection):
+    # type: (psycopg2.extensions.connection) -> None
+    cursor = connection.cursor()  # type: psycopg2.extensions.cursor
+    for name, query in FIXTURE_STATEMENTS.items():
+        cursor.execute('prepare {name} as {query}'.format(
+            name=name,
+            query=query,
+        ))
+    cursor.close()
 
 
 def _create_user(cursor):
     # type: (psycopg2.extensions.cursor) -> None
-    cursor.execute(
-        "insert into"
-        " phpbb_users (user_id, username, username_clean)"
-        " values (2, 'test', 'test')"
-    )
+    cursor.execute('execute create_user')
 
 
 def _create_session(cursor, session_id, user_id):
     # type: (psycopg2.extensions.cursor, str, int) -> None
     cursor.execute(
-        "insert into"
-        " phpbb_sessions (session_id, session_user_id)"
-        " values (%(session_id)s, %(user_id)s)", {
+        'execute create_session (%(session_id)s, %(user_id)s)', {
             'session_id': session_id,
             'user_id': user_id,
         }
@@ -125,49 +272,144 @@ def _create_session(cursor, session_id, user_id):
 def _create_privilege(cursor, privilege_id, privilege):
     # type: (psycopg2.extensions.cursor, int, str) -> None
     cursor.execute(
-        "insert into"
-        " phpbb_acl_options (auth_option_id, auth_option, is_global)"
-        " values (%(privilege_id)s, %(privilege)s, 1)", {
+        'execute create_privilege (%(privilege_id)s, %(privilege)s)', {
             'privilege_id': privilege_id,
             'privilege': privilege,
         }
     )
 
 
+def _create_privileges(
+    cursor,  # type: psycopg2.extensions.cursor
+    privileges,  # type: typing.List[typing.Tuple[int, str]]
+):
+    # type: (...) -> None
+    """Inserts global privileges, given as (id, name), in one statement."""
+    psycopg2.extras.execute_values(
+        cursor,
+        "insert into"
+        " phpbb_acl_options (auth_option_id, auth_option, is_global)"
+        " values %s",
+        privileges,
+        template='(%s, %s, 1)',
+        page_size=1000,
+    )
+
+
 def _grant_privilege(cursor, user_id):
     # type: (psycopg2.extensions.cursor, int) -> None
     # Cryptic value to  allow only m_edit permission
     permission_set = 'HRA0HS'
     cursor.execute(
-        "update phpbb_users"
-        " set"
-        " user_permissions=%(permission_set)s"
-        " where user_id=%(user_id)s", {
+        'execute grant_privilege (%(permission_set)s, %(user_id)s)', {
             'user_id': user_id,
             'permission_set': permission_set,
         }
     )
 
 
-def _create_db():
-    # type: () -> None
-    connection = _get_connection(DB_HOST, DB_ROOT_USER, DB_ROOT_USER)
-    connection.set_isolation_level(0)
+def _ensure_template_db(cursor):
+    # type: (psycopg2.extensions.cursor) -> None
+    """Creates template database with schema, unless schema is unchanged."""
+    schema_sql = _load_schema()
+    schema_hash = hashlib.sha1(schema_sql.encode('utf-8')).hexdigest()
 
-    cursor = connection.cursor()  # type: psycopg2.extensions.cursor
-    cursor.execute('create user {user}'.format(user=DB_USER))
-    cursor.execute('create database {db_name} owner {user};'.format(
+    # Parallel workers must not rebuild the template at the same time, lock
+    # and look the template up in one round trip
+    cursor.execute(
+        "select pg_advisory_lock(hashtext(%(db_name)s));"
+        " select shobj_description(oid, 'pg_database')"
+        " from pg_database"
+        " where datname=%(db_name)s", {
+            'db_name': DB_TEMPLATE_NAME,
+        }
+    )
+    try:
+        row = cursor.fetchone()
+        if row is None or row[0] != schema_hash:
+            _build_template_db(cursor, schema_sql, schema_hash)
+    finally:
+        cursor.execute('select pg_advisory_unlock(hashtext(%(db_name)s))', {
+            'db_name': DB_TEMPLATE_NAME,
+        })
+
+
+def _build_template_db(cursor, schema_sql, schema_hash):
+    # type: (psycopg2.extensions.cursor, typing.Text, str) -> None
+    # Start from scratch, also cleaning up after a crashed run
+    cursor.execute(
+        "update pg_database"
+        " set datistemplate=false"
+        " where datname=%(db_name)s", {
+            'db_name': DB_TEMPLATE_NAME,
+        }
+    )
+    _drop_database(cursor, DB_TEMPLATE_NAME)
+    cursor.execute(
+        "do $$"
+        " begin"
+        " if not exists (select 1 from pg_roles where rolname='{user}') then"
+        " create user {user};"
+        " end if;"
+        " end"
+        " $$".format(user=DB_USER)
+    )
+    cursor.execute('create database {db_name} owner {user}'.format(
+        user=DB_USER,
+        db_name=DB_TEMPLATE_NAME,
+    ))
+
+    template_connection = _get_connection(
+        DB_HOST,
+        DB_USER,
+        DB_TEMPLATE_NAME,
+    )
+    _init_schema(template_connection, schema_sql)
+    template_connection.commit()
+    template_connection.close()
+
+    cursor.execute(
+        "comment on database {db_name} is %(schema_hash)s;"
+        " update pg_database"
+        " set datistemplate=true"
+        " where datname=%(db_name)s".format(
+            db_name=DB_TEMPLATE_NAME,
+        ), {
+            'db_name': DB_TEMPLATE_NAME,
+            'schema_hash': schema_hash,
+        }
+    )
+
+
+def _load_schema():
+    # type: () -> typing.Text
+    global _schema_sql
+
+    if _schema_sql is None:
+        with io.open(SCHEMA_PATH, 'r', encoding='utf-8') as schema_file:
+            _schema_sql = schema_file.read()
+    return _schema_sql
+
+
+def _create_db(cursor):
+    # type: (psycopg2.extensions.cursor) -> None
+    # Drop a database left behind by an interrupted run
+    _drop_database(cursor, DB_NAME)
+
+    # Can not be batched with other statements, as create database refuses
+    # to run inside the implicit transaction of a multi-statement query
+    cursor.execute(
+        'create database {db_name} template {template} owner {user};'.format(
             user=DB_USER,
             db_name=DB_NAME,
+            template=DB_TEMPLATE_NAME,
         )
     )
-    cursor.close()
-    connection.close()
 
 
-def _init_schema(connection):
-    # type: (psycopg2.extensions.connection) -> None
-    schema_sql = open('./tests/fixtures/postgres/schema.sql', 'r').read()
+def _init_schema(connection, schema_sql):
+    # type: (psycopg2.extensions.connection, typing.Text) -> None
+    """Runs whole schema in the open transaction, caller commits once."""
     cursor_schema = connection.cursor()  # type: psycopg2.extensions.cursor
     cursor_schema.execute(schema_sql)
     cursor_schema.close()
@@ -175,33 +417,66 @@ def _init_schema(connection):
 
 def _destory_db():
     # type: () -> None
-    connection = _get_connection(DB_HOST, DB_ROOT_USER, DB_ROOT_USER)
-    connection.set_isolation_level(0)
+    # Template database and its owner are kept for following runs
+    connection = _get_admin_connection()
 
     cursor = connection.cursor()  # type: psycopg2.extensions.cursor
-    cursor.execute('drop database {db_name};'.format(
-            db_name=DB_NAME,
-        )
-    )
-    cursor.execute('drop user {user}'.format(user=DB_USER))
+    _drop_database(cursor, DB_NAME)
     cursor.close()
-    connection.close()
+    _put_admin_connection(connection)
 
 
-def _get_connection(host, user, database):
-    # type: (str, str, str) -> psycopg2.extensions.connection
-    connection_string = (
-        'dbname={db_name}'
-        ' user={user}'
-    )
-    if host:
-        connection_string += ' host={db_host}'
+def _drop_database(cursor, db_name):
+    # type: (psycopg2.extensions.cursor, str) -> None
+    query = 'drop database if exists {db_name}'
+    # Since PostgreSQL 13 lingering sessions can be terminated on the way
+    if cursor.connection.server_version >= 130000:
+        query += ' with (force)'
 
+    cursor.execute(query.format(db_name=db_name))
+
+
+def _get_admin_connection():
+    # type: () -> psycopg2.extensions.connection
+    global _admin_pool
+
+    if _admin_pool is None:
+        _admin_pool = psycopg2.pool.ThreadedConnectionPool(
+            1,
+            8,
+            **_get_connection_kwargs(DB_HOST, DB_ROOT_USER, DB_ROOT_USER)
+        )
+        atexit.register(_admin_pool.closeall)
+
+    connection = _admin_pool.getconn()
+    connection.set_isolation_level(0)
+    return connection
+
+
+def _put_admin_connection(connection):
+    # type: (psycopg2.extensions.connection) -> None
+    if _admin_pool is not None:
+        _admin_pool.putconn(connection)
+
+
+def _get_connection(host, user, database, connection_factory=None):
+    # type: (str, str, str, typing.Any) -> psycopg2.extensions.connection
     connection = psycopg2.connect(
-        connection_string.format(
-            db_name=database,
-            db_host=host,
-            user=user,
-        ),
+        connection_factory=connection_factory,
+        **_get_connection_kwargs(host, user, database)
     )
+    # Schema load and tests rely on running within a single transaction
+    connection.autocommit = False
     return connection
+
+
+def _get_connection_kwargs(host, user, database):
+    # type: (str, str, str) -> typing.Dict[str, typing.Optional[str]]
+    return {
+        'dbname': database,
+        'user': user,
+        'host': host or None,
+        'application_name': 'flask_phpbb3_tests',
+        # Test data is thrown away, do not wait for WAL flush on commit
+        'options': '-c synchronous_commit=off',
+    }
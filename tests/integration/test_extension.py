@@ -1,7 +1,11 @@
 from __future__ import absolute_import
 
+import flask_phpbb3.backends.psycopg2
+
 import mock
 
+import psycopg2.extensions
+
 from . import base
 
 setUpModule = base.setUpModule
@@ -9,11 +13,32 @@ tearDownModule = base.tearDownModule
 
 
 class TestExtension(base.TestWithDatabase):
-    @mock.patch('flask_phpbb3.backends.psycopg2.Psycopg2Backend.close')
-    def test_teardown(self, mocked_close):
-        # type: (mock.Mock) -> None
+    @classmethod
+    def setUpClass(cls):
+        # type: () -> None
+        super(TestExtension, cls).setUpClass()
+        # Started last, failing setup would otherwise leave close mocked
+        cls.close_patcher = mock.patch.object(
+            flask_phpbb3.backends.psycopg2.Psycopg2Backend,
+            'close',
+        )
+        cls.mocked_close = cls.close_patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        # type: () -> None
+        cls.close_patcher.stop()
+        super(TestExtension, cls).tearDownClass()
+
+    def setUp(self):
+        # type: () -> None
+        super(TestExtension, self).setUp()
+        self.mocked_close.reset_mock()
+
+    def test_teardown(self):
+        # type: () -> None
         self.ctx.pop()
-        mocked_close.assert_called()
+        self.mocked_close.assert_called()
         self.ctx.push()
 
 
@@ -41,9 +66,11 @@ class TestGetUser(base.TestWithDatabase):
 class TestFetch(base.TestWithDatabase):
     def test_paging(self):
         # type: () -> None
-        base._create_privilege(self.cursor, 1, 'm_edit')
-        base._create_privilege(self.cursor, 2, 'm_delete')
-        base._create_privilege(self.cursor, 3, 'm_some_random')
+        base._create_privileges(self.cursor, [
+            (1, 'm_edit'),
+            (2, 'm_delete'),
+            (3, 'm_some_random'),
+        ])
 
         expected_privileges = [(0, [{
             'auth_option': 'm_edit',
@@ -71,10 +98,15 @@ class TestFetch(base.TestWithDatabase):
 
 
 class TestSession(base.TestWithDatabase):
-    def setUp(self):
-        # type: () -> None
-        super(TestSession, self).setUp()
-        self.session_id = '123'
+    session_id = '123'
+    # Logs in via phpbb3 cookie, without going through the cookie jar
+    session_headers = {'Cookie': 'phpbb3_sid=' + session_id}
+
+    @classmethod
+    def _create_class_fixtures(cls, cursor):
+        # type: (psycopg2.extensions.cursor) -> None
+        base._create_user(cursor)
+        base._create_session(cursor, cls.session_id, 2)
 
     def test_anonymous(self):
         # type: () -> None
@@ -83,45 +115,37 @@ class TestSession(base.TestWithDatabase):
 
     def test_invalid_session(self):
         # type: () -> None
-        base._create_user(self.cursor)
+        # Cover fetching anonymous user from database
+        self._unprime_anonymous_user()
 
-        data = self.client.get('/?sid=123').data
+        data = self.client.get('/?sid=456').data
         self.assertEqual(data, '1,Anonymous')
 
     def test_user_by_args(self):
         # type: () -> None
-        base._create_user(self.cursor)
-        base._create_session(self.cursor, self.session_id, 2)
-
         data = self.client.get('/?sid=' + self.session_id).data
         self.assertEqual(data, '2,test')
 
     def test_user_by_cookie(self):
         # type: () -> None
-        base._create_user(self.cursor)
-        base._create_session(self.cursor, self.session_id, 2)
-
-        self.client.set_cookie('127.0.0.1', 'phpbb3_sid', self.session_id)
-        data = self.client.get('/').data
+        data = self.client.get('/', headers=self.session_headers).data
         self.assertEqual(data, '2,test')
-        self.client.delete_cookie('127.0.0.1', 'phpbb3_sid')
 
     def test_storage(self):
         # type: () -> None
-        base._create_user(self.cursor)
-        base._create_session(self.cursor, self.session_id, 2)
-
-        self.client.set_cookie('127.0.0.1', 'phpbb3_sid', self.session_id)
-        data = self.client.get('/data').data
+        data = self.client.get('/data', headers=self.session_headers).data
         self.assertEqual(data, '')
 
-        self.client.get('/data/something')
+        self.client.get('/data/something', headers=self.session_headers)
 
-        data = self.client.get('/data').data
+        data = self.client.get('/data', headers=self.session_headers).data
         self.assertEqual(data, 'something')
 
     def test_storage_invalid_id(self):
         # type: () -> None
+        # Cover fetching anonymous user from database
+        self._unprime_anonymous_user()
+
         data = self.client.get('/data').data
         self.assertEqual(data, '')
 
@@ -132,8 +156,8 @@ class TestSession(base.TestWithDatabase):
 
     def test_privilege(self):
         # type: () -> None
-        base._create_user(self.cursor)
-        base._create_session(self.cursor, self.session_id, 2)
+        self._unprime_anonymous_user()
+
         base._create_privilege(self.cursor, 1, 'm_edit')
         base._grant_privilege(self.cursor, 2)
 
@@ -141,7 +165,5 @@ class TestSession(base.TestWithDatabase):
         self.assertEqual(data, 'False,False,False')
 
         # We do a login via phpbb3 :P
-        self.client.set_cookie('127.0.0.1', 'phpbb3_sid', self.session_id)
-
-        data = self.client.get('/priv_test').data
+        data = self.client.get('/priv_test', headers=self.session_headers).data
         self.assertEqual(data, 'True,False,True')
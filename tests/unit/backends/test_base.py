@@ -6,18 +6,12 @@ import flask_phpbb3.backends.base
 
 import mock
 
+import werkzeug.contrib.cache
+
 
 class TestSessionHasPrivilege(unittest.TestCase):
     def setUp(self):
         # type: () -> None
-        user_acl = {
-            '0': ['0'] * 31,
-            '5': ['0'] * 31,
-        }
-        user_acl['0'][0] = '1'
-        user_acl['0'][3] = '1'
-        user_acl['5'][3] = '1'
-
         self.user_acl = flask_phpbb3.backends.base.UserAcl([], '')
         self.user_acl._acl_options = {
             'local': {
@@ -35,8 +29,8 @@ class TestSessionHasPrivilege(unittest.TestCase):
         }
 
         self.user_acl._acl = {
-            '0': ''.join(user_acl['0']),
-            '5': ''.join(user_acl['5']),
+            '0': 1 << 0 | 1 << 3,
+            '5': 1 << 3,
         }
 
     def test_existing(self):
@@ -95,6 +89,26 @@ class TestSessionHasPrivilege(unittest.TestCase):
         )
         self.assertFalse(actual_result)
 
+    def test_forum_id_types(self):
+        # type: () -> None
+        actual_result = self.user_acl.has_privilege(
+            'm_review',
+            forum_id='5'
+        )
+        self.assertTrue(actual_result)
+
+        actual_result = self.user_acl.has_privilege(
+            'm_review',
+            forum_id='0'
+        )
+        self.assertFalse(actual_result)
+
+        actual_result = self.user_acl.has_privilege(
+            'm_review',
+            forum_id=5000
+        )
+        self.assertFalse(actual_result)
+
     def test_negated(self):
         # type: () -> None
         actual_result = self.user_acl.has_privilege(
@@ -159,45 +173,245 @@ class TestSessionHasPrivileges(unittest.TestCase):
             raw_acl_options=[],
             raw_user_permissions='',
         )
+        self.user_acl._acl_options = {
+            'local': {
+                'm_edit': 0,
+                'm_view': 1,
+                'm_review': 3,
+            },
+            'global': {
+                'm_edit': 0,
+                'm_view': 1,
+                'm_delete': 3,
+            },
+        }
 
-    @mock.patch('flask_phpbb3.backends.base.UserAcl.has_privilege')
-    def test_combinations(self, has_privilege_mock):
-        # type: (mock.Mock) -> None
-        privileges = ('m_edit', 'm_delete', 'm_view')
-        has_privilege_mock.return_value = False
+        self.user_acl._acl = {
+            '0': 1 << 0 | 1 << 3,
+            '5': 1 << 3,
+        }
 
-        actual_result = self.user_acl.has_privileges(*privileges)
+    def test_combinations(self):
+        # type: () -> None
+        actual_result = self.user_acl.has_privileges('m_view', 'm_unknown')
         self.assertFalse(actual_result)
 
-        has_privilege_mock.side_effect = [False, False, True]
-        actual_result = self.user_acl.has_privileges(*privileges)
+        actual_result = self.user_acl.has_privileges('m_view', 'm_delete')
         self.assertTrue(actual_result)
 
-        has_privilege_mock.side_effect = [True, False, False]
-        actual_result = self.user_acl.has_privileges(*privileges)
+        actual_result = self.user_acl.has_privileges('m_edit', 'm_view')
         self.assertTrue(actual_result)
 
-        has_privilege_mock.side_effect = [True, True, True]
+    def test_per_forum(self):
+        # type: () -> None
+        privileges = ('m_view', 'm_review')
+
         actual_result = self.user_acl.has_privileges(*privileges)
+        self.assertFalse(actual_result)
+
+        actual_result = self.user_acl.has_privileges(*privileges, forum_id=2)
+        self.assertFalse(actual_result)
+
+        actual_result = self.user_acl.has_privileges(*privileges, forum_id=5)
+        self.assertTrue(actual_result)
+
+    def test_negated(self):
+        # type: () -> None
+        actual_result = self.user_acl.has_privileges('!m_edit', 'm_view')
+        self.assertFalse(actual_result)
+
+        actual_result = self.user_acl.has_privileges('!m_view', 'm_view')
         self.assertTrue(actual_result)
 
-    @mock.patch('flask_phpbb3.backends.base.UserAcl.has_privilege',
-                return_value=False)
-    def test_per_forum(self, has_privilege_mock):
-        # type: (mock.Mock) -> None
-        privileges = ('m_edit', 'm_delete', 'm_view')
-
-        self.user_acl.has_privileges(*privileges)
-        has_privilege_mock.assert_has_calls([
-            mock.call('m_edit', forum_id=0),
-            mock.call('m_delete', forum_id=0),
-            mock.call('m_view', forum_id=0),
-        ], any_order=True)
-
-        has_privilege_mock.reset_mock()
-        self.user_acl.has_privileges(*privileges, forum_id=2)
-        has_privilege_mock.assert_has_calls([
-            mock.call('m_edit', forum_id=2),
-            mock.call('m_delete', forum_id=2),
-            mock.call('m_view', forum_id=2),
-        ], any_order=True)
+        actual_result = self.user_acl.has_privileges(
+            '!m_review',
+            forum_id=5,
+        )
+        self.assertFalse(actual_result)
+
+    def test_masks_cache(self):
+        # type: () -> None
+        privileges = ('m_edit', 'm_review', '!m_view')
+
+        expected_value = (1 << 0, 1 << 0 | 1 << 3, ('!m_view',))
+        self.assertEqual(
+            self.user_acl._get_query_masks(privileges),
+            expected_value,
+        )
+
+        self.user_acl._acl_options = {'local': {}, 'global': {}}
+        self.assertEqual(
+            self.user_acl._get_query_masks(privileges),
+            expected_value,
+        )
+
+
+class TestParseUserPermissions(unittest.TestCase):
+    def test_main(self):
+        # type: () -> None
+        actual_result = flask_phpbb3.backends.base.UserAcl\
+            ._parse_user_permissions('HRA0HS\n\nzik0zj\n')
+
+        self.assertEqual(actual_result, {
+            '0': 1,
+            '2': 2 ** 31 - 1,
+        })
+
+    def test_odd_chunks(self):
+        # type: () -> None
+        actual_result = flask_phpbb3.backends.base.UserAcl\
+            ._parse_user_permissions('HRA0HSzik0zjHRA0HS')
+
+        self.assertEqual(actual_result, {
+            '0': 1 | (2 ** 31 - 1) << 31 | 1 << 62,
+        })
+
+    def test_repeated_lines(self):
+        # type: () -> None
+        actual_result = flask_phpbb3.backends.base.UserAcl\
+            ._parse_user_permissions('HRA0HSzik0zj\nHRA0HSzik0zj')
+
+        expected_value = 1 | (2 ** 31 - 1) << 31
+        self.assertEqual(actual_result, {
+            '0': expected_value,
+            '1': expected_value,
+        })
+
+
+class TestUserAclCache(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        flask_phpbb3.backends.base.UserAcl._instances.clear()
+        self.acl_options = {
+            'local': {},
+            'global': {
+                'm_edit': 0,
+            },
+        }
+
+    def tearDown(self):
+        # type: () -> None
+        flask_phpbb3.backends.base.UserAcl._instances.clear()
+
+    def test_main(self):
+        # type: () -> None
+        user_acl = flask_phpbb3.backends.base.UserAcl.get_cached(
+            'rev1',
+            self.acl_options,
+            'HRA0HS',
+        )
+        self.assertTrue(user_acl.has_privilege('m_edit'))
+
+        actual_result = flask_phpbb3.backends.base.UserAcl.get_cached(
+            'rev1',
+            self.acl_options,
+            'HRA0HS',
+        )
+        self.assertIs(actual_result, user_acl)
+
+    def test_different_revision(self):
+        # type: () -> None
+        user_acl = flask_phpbb3.backends.base.UserAcl.get_cached(
+            'rev1',
+            self.acl_options,
+            'HRA0HS',
+        )
+
+        actual_result = flask_phpbb3.backends.base.UserAcl.get_cached(
+            'rev2',
+            {'local': {}, 'global': {}},
+            'HRA0HS',
+        )
+        self.assertIsNot(actual_result, user_acl)
+        self.assertFalse(actual_result.has_privilege('m_edit'))
+
+    def test_invalidate(self):
+        # type: () -> None
+        user_acl = flask_phpbb3.backends.base.UserAcl.get_cached(
+            'rev1',
+            self.acl_options,
+            'HRA0HS',
+        )
+
+        flask_phpbb3.backends.base.UserAcl.invalidate('HRA0HS')
+
+        actual_result = flask_phpbb3.backends.base.UserAcl.get_cached(
+            'rev1',
+            self.acl_options,
+            'HRA0HS',
+        )
+        self.assertIsNot(actual_result, user_acl)
+
+    def test_size_limit(self):
+        # type: () -> None
+        with mock.patch('flask_phpbb3.backends.base.USER_ACL_CACHE_SIZE', 2):
+            for raw_user_permissions in ('HRA0HS', 'zik0zj', '000000'):
+                flask_phpbb3.backends.base.UserAcl.get_cached(
+                    'rev1',
+                    self.acl_options,
+                    raw_user_permissions,
+                )
+
+        self.assertEqual(
+            [key[1] for key in flask_phpbb3.backends.base.UserAcl._instances],
+            ['zik0zj', '000000'],
+        )
+
+
+class TestGetOptionsRevision(unittest.TestCase):
+    def test_main(self):
+        # type: () -> None
+        raw_acl_options = [{
+            'auth_option': 'm_edit',
+            'is_local': 0,
+            'is_global': 1,
+        }]
+
+        revision = flask_phpbb3.backends.base.UserAcl._get_options_revision(
+            raw_acl_options,
+        )
+        # Same for every process, as it is shared through the cache
+        self.assertEqual(revision, '6ceed865021925defad1cb58e54f00048c373aae')
+
+        raw_acl_options[0]['is_local'] = 1
+        self.assertNotEqual(
+            revision,
+            flask_phpbb3.backends.base.UserAcl._get_options_revision(
+                raw_acl_options,
+            ),
+        )
+
+
+@mock.patch('flask_phpbb3.backends.base.BaseBackend.execute')
+@mock.patch('flask_phpbb3.backends.base.BaseBackend._prepare_statements')
+class TestGetUserAcl(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        flask_phpbb3.backends.base.UserAcl._instances.clear()
+
+    def tearDown(self):
+        # type: () -> None
+        flask_phpbb3.backends.base.UserAcl._instances.clear()
+
+    def test_parsed_options_cache(self, mocked_prepare, mocked_execute):
+        # type: (mock.Mock, mock.Mock) -> None
+        mocked_execute.return_value = [{
+            'auth_option': 'm_edit',
+            'is_local': 0,
+            'is_global': 1,
+        }]
+        cache = werkzeug.contrib.cache.SimpleCache()
+
+        backend = flask_phpbb3.backends.base.BaseBackend(cache, {})
+        user_acl = backend.get_user_acl('HRA0HS')
+        self.assertTrue(user_acl.has_privilege('m_edit'))
+
+        # A fresh backend, as one is created per request
+        backend = flask_phpbb3.backends.base.BaseBackend(cache, {})
+        actual_result = backend.get_user_acl('HRA0HS')
+        self.assertIs(actual_result, user_acl)
+
+        mocked_execute.assert_called_once_with(
+            'fetch_acl_options',
+            limit=None,
+        )
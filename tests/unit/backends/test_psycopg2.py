@@ -242,3 +242,76 @@ class TestPreparedCustomStatements(unittest.TestCase):
             connection._functions['get_autologin'],
             'overriden',
         )
+
+
+@mock.patch(
+    'flask_phpbb3.backends.psycopg2.Psycopg2Backend._setup_connection'
+)
+class TestConnectionState(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            {
+                'TABLE_PREFIX': '',
+            }
+        )
+
+    def test_not_connected(self, mocked_setup_connection):
+        # type: (mock.Mock) -> None
+        self.assertFalse(self.connection.is_closed)
+        self.connection.close()
+
+        mocked_setup_connection.assert_not_called()
+
+    def test_close(self, mocked_setup_connection):
+        # type: (mock.Mock) -> None
+        db = mock.Mock()
+        db.closed = 0
+        self.connection._connection = db
+        self.assertFalse(self.connection.is_closed)
+
+        self.connection.close()
+        db.close.assert_called_once_with()
+
+        db.closed = 1
+        self.assertTrue(self.connection.is_closed)
+        mocked_setup_connection.assert_not_called()
+
+
+@mock.patch('flask_phpbb3.backends.psycopg2.Psycopg2Backend._db')
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.connection = flask_phpbb3.backends.psycopg2.Psycopg2Backend(
+            werkzeug.contrib.cache.SimpleCache(),
+            {
+                'TABLE_PREFIX': '',
+            }
+        )
+
+    def test_invalidate(self, mocked_db):
+        # type: (mock.Mock) -> None
+        cursor = mock.Mock()
+        cursor.fetchone.side_effect = [{'num': 3}, {'num': 4}]
+        mocked_db.cursor.return_value = cursor
+
+        for _ in range(2):
+            actual_value = self.connection.execute(
+                'get_unread_notifications_count',
+                cache=True,
+                user_id=2,
+            )
+            self.assertEqual(actual_value, {'num': 3})
+
+        self.connection.invalidate(
+            'get_unread_notifications_count',
+            user_id=2,
+        )
+
+        actual_value = self.connection.execute(
+            'get_unread_notifications_count',
+            cache=True,
+            user_id=2,
+        )
+        self.assertEqual(actual_value, {'num': 4})
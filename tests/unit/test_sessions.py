@@ -1,8 +1,10 @@
 from __future__ import absolute_import
 
 import hashlib
+import json
 import unittest
 
+import flask_phpbb3
 import flask_phpbb3.sessions
 
 import mock
@@ -58,6 +60,12 @@ class TestSessionMutability(TestSession):
         self.assertEqual(actual_result, 'some_value')
         self.assertTrue(self.session.modified)
 
+    def test_pop_missing(self):
+        # type: () -> None
+        actual_result = self.session.pop('a_key', None)
+        self.assertIsNone(actual_result)
+        self.assertFalse(self.session.modified)
+
     def test_read_only(self):
         # type: () -> None
         self.session._read_only_properties.add('a_key')
@@ -102,6 +110,23 @@ class TestSessionUser(TestSession):
         expected_value = hashlib.sha1(salted_link).hexdigest()[:8]
         self.assertEqual(self.session.get_link_hash(some_link), expected_value)
 
+    def test_get_link_hash_unicode(self):
+        # type: () -> None
+        some_link = u'/my/\u010dlink'
+        self.session['user_form_salt'] = u'some_salt'
+        self.session['user_id'] = '3'
+
+        salted_link = (u'some_salt' + some_link).encode('utf-8')
+        expected_value = hashlib.sha1(salted_link).hexdigest()[:8]
+        self.assertEqual(self.session.get_link_hash(some_link), expected_value)
+
+
+class TestJsonDumps(unittest.TestCase):
+    def test_non_str_keys(self):
+        # type: () -> None
+        actual_result = flask_phpbb3.sessions._json_dumps({1: 'a'})
+        self.assertEqual(json.loads(actual_result), {'1': 'a'})
+
 
 class TestSessionUserMembership(TestSession):
     def setUp(self):
@@ -267,4 +292,145 @@ class TestUnreadNotificationsNum(TestSession):
 
         mocked_phpbb3.get_unread_notifications_count.assert_called_once_with(
             user_id=user_id,
+            cache=True,
+            cache_ttl=flask_phpbb3.sessions.UNREAD_NOTIFICATIONS_CACHE_TTL,
         )
+
+
+class TestSessionInterfaceIsBot(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.interface = flask_phpbb3.sessions.PhpBB3SessionInterface()
+        self.app = mock.Mock()
+        self.app.phpbb3_botlist = flask_phpbb3.PhpBB3._compile_botlist([
+            'Googlebot',
+            'Mozilla/5.0 (compatible; bingbot',
+        ])
+        self.request = mock.Mock()
+        self.request.headers = {}
+
+    def test_bot(self):
+        # type: () -> None
+        self.request.headers['User-Agent'] = 'Googlebot/2.1'
+        self.assertTrue(self.interface._is_bot(self.app, self.request))
+
+        self.request.headers['User-Agent'] =\
+            'Mozilla/5.0 (compatible; bingbot/2.0)'
+        self.assertTrue(self.interface._is_bot(self.app, self.request))
+
+    def test_prefix_only(self):
+        # type: () -> None
+        self.request.headers['User-Agent'] = 'Mozilla/5.0 Googlebot/2.1'
+        self.assertFalse(self.interface._is_bot(self.app, self.request))
+
+    def test_no_user_agent(self):
+        # type: () -> None
+        self.assertFalse(self.interface._is_bot(self.app, self.request))
+
+    def test_empty_botlist(self):
+        # type: () -> None
+        self.app.phpbb3_botlist = flask_phpbb3.PhpBB3._compile_botlist([])
+        self.request.headers['User-Agent'] = 'Googlebot/2.1'
+        self.assertFalse(self.interface._is_bot(self.app, self.request))
+
+
+class TestSessionInterfaceStoredData(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.interface = flask_phpbb3.sessions.PhpBB3SessionInterface()
+        self.app = mock.Mock()
+        self.app.config = {
+            'PHPBB3_SESSION_BACKEND': {
+                'LOCAL_CACHE_TTL': 30,
+            },
+        }
+
+    def test_local_cache(self):
+        # type: () -> None
+        self.app.phpbb3_cache.get.return_value = '{"a_key": 1}'
+
+        actual_result = self.interface._get_stored_data(self.app, 'key')
+        self.assertEqual(actual_result, '{"a_key": 1}')
+
+        actual_result = self.interface._get_stored_data(self.app, 'key')
+        self.assertEqual(actual_result, '{"a_key": 1}')
+
+        self.app.phpbb3_cache.get.assert_called_once_with('key')
+
+    def test_set(self):
+        # type: () -> None
+        self.interface._set_stored_data(self.app, 'key', '{"a_key": 2}')
+
+        actual_result = self.interface._get_stored_data(self.app, 'key')
+        self.assertEqual(actual_result, '{"a_key": 2}')
+
+        self.app.phpbb3_cache.set.assert_called_once_with(
+            'key',
+            '{"a_key": 2}',
+            timeout=int(3600 * 1.5),
+        )
+        self.app.phpbb3_cache.get.assert_not_called()
+
+    def test_disabled(self):
+        # type: () -> None
+        self.app.config['PHPBB3_SESSION_BACKEND']['LOCAL_CACHE_TTL'] = 0
+        self.app.phpbb3_cache.get.return_value = '{"a_key": 1}'
+
+        self.interface._set_stored_data(self.app, 'key', '{"a_key": 2}')
+        self.interface._get_stored_data(self.app, 'key')
+        self.interface._get_stored_data(self.app, 'key')
+
+        self.assertEqual(self.app.phpbb3_cache.get.call_count, 2)
+
+
+class TestSessionInterfaceSaveSession(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.interface = flask_phpbb3.sessions.PhpBB3SessionInterface()
+        self.app = mock.Mock()
+        self.app.config = {
+            'PHPBB3_SESSION_BACKEND': {
+                'LOCAL_CACHE_TTL': 0,
+            },
+        }
+
+        self.session = flask_phpbb3.sessions.PhpBB3Session()
+        self.session._read_only_properties = frozenset(['session_id'])
+        self.session.update({'session_id': '123', 'a_key': 'value'})
+        self.session._stored_data = flask_phpbb3.sessions._json_dumps({
+            'a_key': 'value',
+        })
+
+    def test_unmodified(self):
+        # type: () -> None
+        self.interface.save_session(self.app, self.session, mock.Mock())
+        self.app.phpbb3_cache.set.assert_not_called()
+
+    def test_same_data(self):
+        # type: () -> None
+        self.session['a_key'] = 'other'
+        self.session['a_key'] = 'value'
+        self.assertTrue(self.session.modified)
+
+        self.interface.save_session(self.app, self.session, mock.Mock())
+        self.app.phpbb3_cache.set.assert_not_called()
+
+    def test_modified(self):
+        # type: () -> None
+        self.session['a_key'] = 'other'
+
+        self.interface.save_session(self.app, self.session, mock.Mock())
+        self.app.phpbb3_cache.set.assert_called_once_with(
+            'sessions_123',
+            flask_phpbb3.sessions._json_dumps({'a_key': 'other'}),
+            timeout=int(3600 * 1.5),
+        )
+
+    def test_no_session_id(self):
+        # type: () -> None
+        self.session._read_only_properties = frozenset(['user_id'])
+        del self.session['session_id']
+        self.session['a_key'] = 'other'
+
+        self.interface.save_session(self.app, self.session, mock.Mock())
+        self.app.phpbb3_cache.set.assert_not_called()